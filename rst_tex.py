@@ -33,6 +33,7 @@
 # Ref: tools/old/nicklatex.py
 
 import inspect
+import contextlib
 from docutils import writers, nodes, utils
 from docutils.parsers.rst import directives, Directive, roles
 
@@ -47,21 +48,61 @@ VERSION = "1.0"
 class Writer(writers.Writer):
   """Main class used by doctutils to write the parsed document."""
 
-  def __init__(self, template="template.tex", extension_module=None, source_filename=None):
+  def __init__(self, template="template.tex", extension_module=None, source_filename=None, split_sections=None, label_index=None, batch_encode=False, stats=None, highlight_listings=False, highlight_cache_dir=None, minimal_escaping=False, memoize_directives=False):
     writers.Writer.__init__(self)
     
     self.translator_class = None
     self.source_filename = source_filename
+
+    # If set, each top-level section is rendered to its own part, named with
+    # this prefix, and the body \input's it.  See self.sections.
+    self.split_sections = split_sections
+    self.sections = []
+
+    # Files the last render depended on, for build tools.  See self.translate.
+    self.dependencies = []
+
+    # Keys cited by the last render, in order of first citation.
+    self.cite_keys = []
+
+    # Hashes of files whose content (not just name) the last render's output
+    # depends on, e.g. highlighted listings.
+    self.content_dependencies = {}
+
+    # The files each file of the last render included with rst_include, as
+    # {including filename: [included filenames]}.
+    self.include_graph = {}
+
+    # Highlight literal_include listings with pygments, rather than in latex.
+    self.highlight_listings = highlight_listings
+    self.highlight_cache_dir = highlight_cache_dir
+
+    # Encode all of a document's text at once with a BatchEncoder (needs numpy).
+    self.batch_encode = batch_encode
+
+    # Leave hyphens, quotes and commas unbraced, except where they would form
+    # a ligature.  See LatexTranslator.brace_ligatures.
+    self.minimal_escaping = minimal_escaping
+
+    # Reuse the output of directives' write for nodes with the same args and
+    # options.  See WriterDirective.memoize.
+    self.memoize_directives = memoize_directives
+
+    # Labels, refs and cites, which may be shared across documents.
+    self.label_index = label_index or LabelIndex()
+
+    # If set, a RenderStats to record the cost of translating documents in.
+    self.stats = stats
     
 
-    # See if a custom LatexTranslator has been passed in a module.
+    # See if a custom LatexTranslator and directives have been passed in a module.
     self.extension_module = None
+    self.extension_filename = None
+    self.extension_directives = []
     if extension_module :
-      self.extension_module = self._import_module(extension_module)
-      for item_name, item in self.extension_module.__dict__.iteritems() :
-        if inspect.isclass(item) and issubclass(item, LatexTranslator) :
-          self.translator_class = item
-          break;
+      self.extension_module, translator_class, self.extension_directives = load_extension_module(extension_module)
+      self.extension_filename = extension_module
+      self.translator_class = translator_class
     
     if not self.translator_class :
       self.translator_class = LatexTranslator
@@ -84,40 +125,848 @@ class Writer(writers.Writer):
         roles.register_canonical_role(role_name, generic_raw_role)
         d("Registered raw role %s" % role_name)
 
-    # Register directives, first from this module, the from an extension module, so can overload.
-    items = globals()
-    if self.extension_module :
-      items.update(self.extension_module.__dict__)
-    for item_name, item in items.iteritems() :
-      if inspect.isclass(item) and issubclass(item, WriterDirective) and item != WriterDirective:
-        d("Registering directive %s" % item_name)
-        directives.register_directive(item.__name__, item)
+    # Register directives, first from this module, then from an extension module, so can overload.
+    for item in find_directive_classes(globals()) + self.extension_directives :
+      d("Registering directive %s" % item.__name__)
+      directives.register_directive(item.__name__, item)
 
 
   def translate(self):
+    self.translate_documents([self.document])
+
+  def translate_documents(self, documents) :
+    """Translates a sequence of documents (e.g. the chunks of one source) into a
+    single output, with one translator, so that its state (section levels,
+    title, parts, etc.) carries over from one to the next.
+
+    documents may be a generator, so that only one need be held at a time.
+    """
+    # The translator adds files referenced by the document (e.g. images) to these.
+    self.dependencies = []
+    self.content_dependencies = {}
+    self.cite_keys = []
+    self.include_graph = {}
+    for filename in [self.source_filename, self.template, self.extension_filename] :
+      if filename :
+        self.add_dependency(filename)
+
+    # Forget what the document defined last time it was rendered.
+    self.label_index.forget_source(self.source_name())
+
     # Create our translator, which will generate parts of the document.
-    visitor = self.translator_class(self.document, writer=self)
+    import os
+    visitor = None
+    for document in documents :
+      self.document = document
+      with self.phase("translate") :
+        if visitor :
+          visitor.document = document
+        else :
+          visitor = self.translator_class(document, writer=self)
     
-    # This sets off the writing of document nodes.
-    self.document.walkabout(visitor)
+        # This sets off the writing of document nodes.
+        document.walkabout(visitor)
+
+      for including, included in getattr(document, "include_graph", {}).items() :
+        self.include_graph.setdefault(including, [])
+        for filename in included :
+          if filename not in self.include_graph[including] :
+            self.include_graph[including].append(filename)
+          self.add_dependency(filename)
+          # A cached render is stale if an included file changes.
+          if os.path.exists(filename) :
+            self.content_dependencies[filename] = file_hash(filename)
     
     #
     # Set the render parts, which are simply attributes of the writer and 'output' is
     # a special rendering of the whole document
     #
     
-    self.output = visitor.astext()
+    with self.phase("astext") :
+      self.output = visitor.astext()
+      self.sections = [(name, visitor.part_text(part)) for name, part in visitor.sections]
+
+    if self.stats :
+      self.stats.counters.update(visitor.counters())
+
+  def phase(self, name) :
+    """Returns a context in which to run a phase of rendering, recording its
+    cost if we are collecting stats."""
+    return phase(self.stats, name)
     
+  def source_name(self) :
+    return self.source_filename or "<string>"
+
+  def add_dependency(self, filename, extensions=None) :
+    """Records a file the render depends on.
+
+    If the file does not exist and extensions are given (e.g. for an image
+    referenced without its extension), the first existing filename with one
+    of the extensions is recorded instead.
+    """
+    import os
+    if extensions and not os.path.exists(filename) :
+      for extension in extensions :
+        if os.path.exists(filename + extension) :
+          filename = filename + extension
+          break
+    if filename not in self.dependencies :
+      self.dependencies.append(filename)
+
   def _import_module(self, module_file) :
     """Import a module by its path."""
     if not module_file :
       return None
-    import os, sys
-    mod_dir = os.path.dirname(module_file)
-    module_name = os.path.basename(module_file).rstrip(".py")
-    if mod_dir :
-      sys.path.append(mod_dir)
-    return __import__(module_name)
+    return load_extension_module(module_file)[0]
+
+
+#################################################################
+# Publishing
+#
+
+# Settings the script renders with.
+DEFAULT_SETTINGS = {
+  'input_encoding': 'unicode',
+  'output_encoding': 'latin-1', # Latin-1 used in docutils core - latex handles this.
+}
+
+def read_source(filename) :
+  """Reads an rst file, ignoring anything after END_OF_TEXT."""
+  import codecs
+  source = codecs.open(filename, "r", "utf-8").read()
+
+  # Its useful if we can ignore the lower part of text when reformatting.
+  return source.split("END_OF_TEXT")[0]
+
+def publish(source, writer, settings_overrides=None, source_path=None, stats=None, chunked=False, lean=False) :
+  """Renders a string with the writer, as docutils.core.publish_string does, but
+  through separate parse, transform and write phases, so that their cost can
+  be recorded in stats (a RenderStats).  See RenderSession.render for chunked,
+  and RenderSession for lean."""
+  with phase(stats, "settings") :
+    session = RenderSession(writer, settings_overrides, lean)
+  return session.render(source, source_path, stats, chunked)
+
+
+class RenderSession(object) :
+  """Renders many documents with one writer.
+
+  The docutils settings, reader and parser are built once, rather than for
+  every document as docutils.core.publish_string does, which for small
+  documents costs more than rendering them.
+
+  If lean, only the transforms the writer needs are applied (see
+  lean_transforms), rather than all those of the standalone reader.
+  """
+
+  def __init__(self, writer, settings_overrides=None, lean=False) :
+    from docutils import frontend
+    from docutils.readers import standalone
+    from docutils.parsers import rst
+    self.writer = writer
+    self.lean = lean
+    self.reader = standalone.Reader()
+    self.parser = rst.Parser()
+    if settings_overrides is None :
+      settings_overrides = DEFAULT_SETTINGS
+    option_parser = frontend.OptionParser(components=(self.parser, self.reader, self.writer), defaults=settings_overrides, read_config_files=True)
+    self.settings = option_parser.get_default_values()
+
+  def render(self, source, source_path=None, stats=None, chunked=False) :
+    """Renders an rst string, returning the output encoded as the settings say.
+
+    If chunked, the source is parsed and translated a top-level section at a
+    time (see split_source_sections), so that only one section's doctree is
+    in memory at once.  Substitutions, targets, etc. only resolve within a
+    chunk, so a source whose sections refer to each other's is not split.
+    Warnings give line numbers within the chunk.
+    """
+    from docutils import core, io
+    writer = self.writer
+    # Otherwise record into any stats the writer was made with.
+    if stats is None :
+      stats = writer.stats
+    else :
+      writer.stats = stats
+    writer.source_filename = source_path
+    # The publisher falls back to the settings' source path, which is shared
+    # by every render, so set it for this one.
+    self.settings._source = source_path
+
+    publisher = core.Publisher(reader=self.reader, parser=self.parser, writer=writer, settings=self.settings, source_class=io.StringInput, destination_class=io.StringOutput)
+    publisher.set_source(source, source_path)
+    publisher.set_destination()
+
+    if chunked :
+      writer.translate_documents(self.read_chunks(source, source_path, publisher.destination, stats))
+      output = publisher.destination.write(writer.output)
+      writer.assemble_parts()
+      writer.document = None
+      return output
+
+    document = self.read(publisher.source, self.settings, publisher.destination, stats)
+
+    # The writer records the translate and astext phases.
+    output = writer.write(document, publisher.destination)
+    writer.assemble_parts()
+    return output
+
+  def read(self, source, settings, destination, stats=None) :
+    """Parses a docutils input into a document and applies the transforms."""
+    with phase(stats, "parse") :
+      document = self.reader.read(source, self.parser, settings)
+
+    with phase(stats, "transforms") :
+      transformer = document.transformer
+      transformer.populate_from_components((source, self.reader, self.parser, self.writer, destination))
+      if self.lean :
+        # Keep those that directives asked for (with pending nodes), though.
+        needed = lean_transforms()
+        transformer.transforms = [transform for transform in transformer.transforms if transform[1] in needed or transform[2] is not None]
+      transformer.apply_transforms()
+
+    if stats :
+      stats.counters["transforms_applied"] = stats.counters.get("transforms_applied", 0) + len(transformer.applied)
+
+    return document
+
+  def read_chunks(self, source, source_path, destination, stats=None) :
+    """Generates a document for each chunk of the source."""
+    import copy
+    from docutils import io
+
+    # Only the first chunk may hold the document title.
+    chunk_settings = copy.copy(self.settings)
+    chunk_settings.doctitle_xform = False
+    chunk_settings.docinfo_xform = False
+
+    for index, chunk in enumerate(split_source_sections(source)) :
+      settings = index and chunk_settings or self.settings
+      chunk_input = io.StringInput(source=chunk, source_path=source_path, encoding=settings.input_encoding)
+      document = self.read(chunk_input, settings, destination, stats)
+      yield document
+      document = None # So it may be freed while we parse the next chunk.
+
+  def render_file(self, filename, stats=None, chunked=False) :
+    with phase(stats, "read") :
+      source = read_source(filename)
+    return self.render(source, filename, stats, chunked)
+
+
+def render_many(items, writer_options=None, settings_overrides=None, lean=False, workers=0, processes=False, max_pending=64) :
+  """Renders (key, rst string) items, lazily yielding (key, output) in order,
+  where output is the latex, or the exception raised rendering it.
+
+  Each worker renders with one warm Writer (made with writer_options) and
+  RenderSession.  With workers, items are rendered in parallel by a pool of
+  that many threads or, if processes, processes (threads only help if reading
+  items or using results blocks).  At most max_pending items are read ahead of
+  the result last yielded, so neither items nor results need all be in memory.
+  """
+  import collections
+  writer_options = writer_options or {}
+  if not workers :
+    session = RenderSession(Writer(**writer_options), settings_overrides, lean)
+    for key, source in items :
+      yield key, _render_item(session, source)
+    return
+
+  from multiprocessing import pool
+  pool_class = processes and pool.Pool or pool.ThreadPool
+  # Identifies this call's sessions among those of other calls' workers.
+  token = object()
+  if processes :
+    token = None # Each process has its own _render_sessions.
+  worker_pool = pool_class(workers, _init_render_worker, (token, writer_options, settings_overrides, lean))
+  pending = collections.deque()
+  try :
+    for key, source in items :
+      pending.append((key, worker_pool.apply_async(_render_worker_item, (token, source, processes))))
+      if len(pending) >= max_pending :
+        key, result = pending.popleft()
+        yield key, result.get()
+    while pending :
+      key, result = pending.popleft()
+      yield key, result.get()
+    worker_pool.close()
+  finally :
+    # Stops the workers if the caller stops iterating early.
+    worker_pool.terminate()
+    worker_pool.join()
+    for session_key in _render_sessions.keys() :
+      if session_key[0] is token :
+        del _render_sessions[session_key]
+
+# The RenderSession of each render_many worker, by (call token, thread).
+_render_sessions = {}
+
+def _init_render_worker(token, writer_options, settings_overrides, lean) :
+  import threading
+  writer = Writer(**writer_options)
+  _render_sessions[(token, threading.current_thread().ident)] = RenderSession(writer, settings_overrides, lean)
+
+def _render_worker_item(token, source, pickled=False) :
+  import threading
+  return _render_item(_render_sessions[(token, threading.current_thread().ident)], source, pickled)
+
+def _render_item(session, source, pickled=False) :
+  """Renders source with the session, returning any exception raised (as a
+  RuntimeError, if it must be pickled but cannot be)."""
+  try :
+    return session.render(source)
+  except Exception, e :
+    if pickled :
+      import pickle
+      try :
+        pickle.loads(pickle.dumps(e))
+      except Exception :
+        e = RuntimeError("%s: %s" % (e.__class__.__name__, e))
+    return e
+
+
+def lean_transforms() :
+  """Returns the docutils transforms that affect our output.  The translator
+  ignores references, targets and comments, so e.g. hyperlink resolution and
+  the checks of it are not needed."""
+  from docutils.transforms import references, frontmatter, universal
+  return [
+    references.Substitutions,
+    frontmatter.DocTitle,
+    frontmatter.SectionSubTitle,
+    frontmatter.DocInfo,
+    universal.Messages,
+    universal.FilterMessages, # Removes messages below the report level.
+  ]
+
+
+# Characters rst allows in section title adornments.
+ADORNMENT_CHARS = "!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~"
+
+def split_source_sections(source) :
+  """Splits rst source into chunks, each starting at a top-level section title
+  (the first chunk holds anything before the first, e.g. the document title).
+
+  Parsing each chunk alone gives the same sections as parsing the whole
+  source.  If the source cannot be usefully split, returns it as one chunk.
+  """
+  lines = source.splitlines(True)
+
+  # Find section titles, as (first line, adornment style).
+  titles = []
+  for index in range(1, len(lines)) :
+    underline = lines[index].rstrip()
+    text = lines[index-1].rstrip()
+    if not _is_adornment(underline, text) or not text or text[0].isspace() or _is_adornment(text, text) :
+      continue
+    start, overline = index - 1, False
+    if start > 0 and lines[start-1].rstrip() == underline :
+      start, overline = start - 1, True
+    if start > 0 and lines[start-1].strip() :
+      continue
+    titles.append((start, (underline[0], overline)))
+
+  if not titles :
+    return [source]
+
+  # A first style used once, for the first thing in the source, is the
+  # document title, so split at the next style.
+  styles = []
+  for start, style in titles :
+    if style not in styles :
+      styles.append(style)
+  first_start, first_style = titles[0]
+  first_content = [index for index, line in enumerate(lines) if line.strip()][0]
+  split_style = styles[0]
+  if [style for start, style in titles].count(first_style) == 1 and first_start == first_content :
+    if len(styles) < 2 :
+      return [source]
+    split_style = styles[1]
+
+  # With one section, docutils would promote its title to a subtitle.
+  split_starts = [start for start, style in titles if style == split_style]
+  if len(split_starts) < 2 :
+    return [source]
+
+  line_offsets = [0]
+  for line in lines :
+    line_offsets.append(line_offsets[-1] + len(line))
+  boundaries = [0] + [line_offsets[start] for start in split_starts] + [len(source)]
+  chunks = [source[start:end] for start, end in zip(boundaries[:-1], boundaries[1:])]
+
+  # Substitutions, targets, footnotes, etc. only resolve within a chunk, so do
+  # not split if a chunk refers to something another defines.
+  if _references_cross_chunks(chunks) :
+    return [source]
+  return chunks
+
+def _references_cross_chunks(chunks) :
+  """Returns True if a chunk refers to a substitution, target, footnote, etc.
+  (or a section title) that is defined in another chunk."""
+  import re
+  definition = re.compile(r"^\.\.\s+(?:\|([^|]+)\||_`([^`]+)`:|_([^:`][^:]*):|\[([^\]]+)\])", re.M)
+  inline_target = re.compile(r"_`([^`]+)`")
+  references = [
+    re.compile(r"\|([^|\s](?:[^|]*[^|\s])?)\|"), # |substitution|
+    re.compile(r"`([^`<]+?)\s*`__?"), # `phrase reference`_
+    re.compile(r"(?<![\w`|])(\w[\w.+-]*)__?(?!\w)"), # reference_
+    re.compile(r"\[([^\]]+)\]_"), # [footnote]_ or [citation]_
+  ]
+  normalise = lambda name : " ".join(name.split()).lower()
+
+  defined, referenced = [], []
+  for chunk in chunks :
+    names = set()
+    for groups in definition.findall(chunk) :
+      names.update([normalise(name) for name in groups if name])
+    names.update([normalise(name) for name in inline_target.findall(chunk)])
+    lines = chunk.splitlines()
+    for index in range(1, len(lines)) :
+      if lines[index-1].strip() and _is_adornment(lines[index].rstrip(), lines[index-1].strip()) :
+        names.add(normalise(lines[index-1]))
+    defined.append(names)
+
+    names = set()
+    for reference in references :
+      names.update([normalise(name) for name in reference.findall(chunk)])
+    referenced.append(names)
+
+    # Anonymous references pair with anonymous targets in order.
+    if len(re.findall(r"`__|\w__(?!\w)", chunk)) != len(re.findall(r"^\.\.\s+__:|^__\s", chunk, re.M)) :
+      return True
+
+  all_defined = set().union(*defined)
+  for chunk_defined, chunk_referenced in zip(defined, referenced) :
+    if (chunk_referenced & all_defined) - chunk_defined :
+      return True
+  return False
+
+def _is_adornment(line, title) :
+  """Returns True if the line could be a title's under/overline."""
+  return len(line) >= min(4, len(title) or 4) and line[0] in ADORNMENT_CHARS and line == line[0] * len(line)
+
+
+class RenderStats(object) :
+  """Records the wall time, CPU time and memory use of each phase of a render,
+  along with counters of work done, for reporting (e.g. as JSON).
+
+  Memory is the process's peak resident set size (from getrusage), at the end
+  of the phase and its growth during it, and the change in the number of
+  objects the garbage collector tracks.
+  """
+
+  def __init__(self) :
+    self.phases = []
+    self.counters = {}
+
+  @staticmethod
+  def peak_memory() :
+    """Returns the process's peak resident set size so far, in bytes, or None
+    where getrusage is not available."""
+    try :
+      import resource
+    except ImportError :
+      return None
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, Mac OS X bytes.
+    if sys.platform != "darwin" :
+      peak *= 1024
+    return peak
+
+  @contextlib.contextmanager
+  def phase(self, name) :
+    import time, gc
+    start_peak = self.peak_memory()
+    start_objects = len(gc.get_objects())
+    start_wall, start_cpu = time.time(), time.clock()
+    try :
+      yield
+    finally :
+      peak, memory_delta = self.peak_memory(), None
+      if peak is not None :
+        memory_delta = peak - start_peak
+      self.phases.append({
+        "name": name,
+        "wall_time": time.time() - start_wall,
+        "cpu_time": time.clock() - start_cpu,
+        "peak_memory": peak,
+        "memory_delta": memory_delta,
+        "live_objects_delta": len(gc.get_objects()) - start_objects,
+      })
+
+  def as_dict(self) :
+    return {"phases": self.phases, "counters": self.counters}
+
+def phase(stats, name) :
+  """Returns a context in which to run a phase of rendering, recording its cost
+  in stats, if given."""
+  if stats :
+    return stats.phase(name)
+  return _null_phase()
+
+@contextlib.contextmanager
+def _null_phase() :
+  yield
+
+
+#################################################################
+# Render cache
+#
+
+def render_cache_key(source, template, extension_module=None, options=None) :
+  """Returns a key identifying a render by everything that determines its output:
+  the source, the template and extension module contents, any writer options
+  and the versions of rst_tex and docutils."""
+  import hashlib, docutils
+  key = hashlib.sha1()
+  key.update(source.encode("utf-8"))
+  for filename in [template, extension_module] :
+    key.update("\0")
+    if filename :
+      key.update(open(filename, "rb").read())
+  key.update("\0%s\0%s\0%r" % (VERSION, docutils.__version__, options))
+  return key.hexdigest()
+
+
+def file_hash(filename) :
+  """Returns a hash of a file's content."""
+  import hashlib
+  return hashlib.sha1(open(filename, "rb").read()).hexdigest()
+
+
+class CacheBackend(object) :
+  """Storage for cached renders, mapping keys to byte strings.  Subclass this to
+  store them somewhere other than a local directory."""
+
+  def get(self, key) :
+    """Returns the value for a key, or None if it is not cached."""
+    raise NotImplementedError
+
+  def set(self, key, value) :
+    raise NotImplementedError
+
+
+class DirectoryCache(CacheBackend) :
+  """Caches values as files in a directory, which may be shared (e.g. mounted)
+  between machines.  Once the files exceed max_size bytes, the least recently
+  used are removed."""
+
+  def __init__(self, directory, max_size=100 * 1024 * 1024) :
+    self.directory = directory
+    self.max_size = max_size
+
+  def path(self, key) :
+    import os
+    return os.path.join(self.directory, key[:2], key)
+
+  def get(self, key) :
+    import os
+    path = self.path(key)
+    try :
+      value = open(path, "rb").read()
+    except IOError :
+      return None
+    try :
+      os.utime(path, None) # Mark as recently used.
+    except OSError :
+      pass
+    d("Render cache hit %s" % key)
+    return value
+
+  def set(self, key, value) :
+    import os, tempfile
+    path = self.path(key)
+    if not os.path.isdir(os.path.dirname(path)) :
+      try :
+        os.makedirs(os.path.dirname(path))
+      except OSError :
+        pass # Perhaps made by another process.
+
+    # Write then rename, so readers never see a partial file.
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+    os.write(handle, value)
+    os.close(handle)
+    os.rename(temp_path, path)
+
+    self.evict()
+
+  def evict(self) :
+    """Removes the least recently used files while the cache is over max_size."""
+    import os
+    entries = []
+    total_size = 0
+    for directory, subdirectories, filenames in os.walk(self.directory) :
+      for filename in filenames :
+        path = os.path.join(directory, filename)
+        try :
+          status = os.stat(path)
+        except OSError :
+          continue
+        entries.append((status.st_mtime, status.st_size, path))
+        total_size += status.st_size
+
+    for mtime, size, path in sorted(entries) :
+      if total_size <= self.max_size :
+        break
+      try :
+        os.remove(path)
+      except OSError :
+        pass
+      total_size -= size
+
+
+#################################################################
+# Label index
+#
+
+class LabelIndex(object) :
+  """An index of the labels documents define and the labels and citation keys
+  they reference, so that dangling references and duplicate labels can be
+  found without running latex.
+
+  The index can be saved and loaded, to check references across documents.
+  """
+
+  def __init__(self) :
+    self.labels = {} # label -> [[source, detail], ...]
+    self.refs = {}   # label -> [source, ...]
+    self.cites = {}  # key -> [source, ...]
+
+  @classmethod
+  def load(cls, filename) :
+    """Loads an index saved with save, or returns an empty index if there is none."""
+    import os, json
+    index = cls()
+    if os.path.exists(filename) :
+      data = json.load(open(filename, "r"))
+      index.labels, index.refs, index.cites = data["labels"], data["refs"], data["cites"]
+    return index
+
+  def save(self, filename) :
+    import json
+    write_if_changed(filename, json.dumps({"labels": self.labels, "refs": self.refs, "cites": self.cites}, indent=1, sort_keys=True), "utf-8")
+
+  def add_label(self, label, source, detail=None) :
+    self.labels.setdefault(label, []).append([source, detail])
+
+  def add_ref(self, label, source) :
+    self.refs.setdefault(label, []).append(source)
+
+  def add_cite(self, key, source) :
+    self.cites.setdefault(key, []).append(source)
+
+  def forget_source(self, source) :
+    """Removes everything recorded for a source, before it is indexed again."""
+    for entries in [self.labels, self.refs, self.cites] :
+      for key, values in entries.items() :
+        values = [value for value in values if value != source and not (isinstance(value, list) and value[0] == source)]
+        if values :
+          entries[key] = values
+        else :
+          del entries[key]
+
+  def source_records(self, source) :
+    """Returns what is recorded for a source, e.g. to cache with its render."""
+    return {
+      "labels": [[label, detail] for label, definitions in sorted(self.labels.items()) for definition_source, detail in definitions if definition_source == source],
+      "refs": [label for label, sources in sorted(self.refs.items()) for ref_source in sources if ref_source == source],
+      "cites": [key for key, sources in sorted(self.cites.items()) for cite_source in sources if cite_source == source],
+    }
+
+  def replace_source_records(self, source, records) :
+    """Replaces what is recorded for a source with records from source_records."""
+    self.forget_source(source)
+    for label, detail in records["labels"] :
+      self.add_label(label, source, detail)
+    for label in records["refs"] :
+      self.add_ref(label, source)
+    for key in records["cites"] :
+      self.add_cite(key, source)
+
+  def dangling_refs(self, source=None) :
+    """Returns [(label, sources)] for refs to labels no document defines."""
+    dangling = []
+    for label, sources in sorted(self.refs.items()) :
+      if label not in self.labels and (source is None or source in sources) :
+        dangling.append((label, sorted(set(sources))))
+    return dangling
+
+  def duplicate_labels(self, source=None) :
+    """Returns [(label, definitions)] for labels defined more than once."""
+    duplicates = []
+    for label, definitions in sorted(self.labels.items()) :
+      if len(definitions) > 1 and (source is None or source in [definition[0] for definition in definitions]) :
+        duplicates.append((label, definitions))
+    return duplicates
+
+
+#################################################################
+# Bibliography
+#
+
+class BibIndex(object) :
+  """An index of the entries in a .bib file, by key, as byte offsets, so that a
+  document's entries can be taken from a large library without parsing it.
+
+  The index is saved alongside the .bib file and rebuilt when that changes.
+  """
+
+  def __init__(self, bib_filename, index_filename=None) :
+    self.bib_filename = bib_filename
+    self.index_filename = index_filename or bib_filename + ".index"
+    self.entries = {}  # key -> [offset, length]
+    self.strings = []  # [offset, length] of each @string and @preamble
+    self.load()
+
+  def stamp(self) :
+    import os
+    status = os.stat(self.bib_filename)
+    return [status.st_mtime, status.st_size]
+
+  def load(self) :
+    import os, json
+    stamp = self.stamp()
+    if os.path.exists(self.index_filename) :
+      try :
+        index = json.load(open(self.index_filename, "r"))
+      except ValueError :
+        index = None
+      if index and index["stamp"] == stamp :
+        self.entries, self.strings = index["entries"], index["strings"]
+        return
+
+    d("Indexing %s" % self.bib_filename)
+    self.build()
+    write_if_changed(self.index_filename, json.dumps({"stamp": stamp, "entries": self.entries, "strings": self.strings}))
+
+  def build(self) :
+    """Scans the .bib file for the extent of each entry."""
+    import re
+    bib = open(self.bib_filename, "rb").read()
+    self.entries, self.strings = {}, []
+    for match in re.finditer(r"@\s*(\w+)\s*([{(])", bib) :
+      entry_type = match.group(1).lower()
+      end = self._entry_end(bib, match.end(), match.group(2))
+      if entry_type == "comment" or end is None :
+        continue
+      extent = [match.start(), end - match.start()]
+      if entry_type in ["string", "preamble"] :
+        self.strings.append(extent)
+      else :
+        # An entry without fields (and so no comma) is of no use.
+        key_end = bib.find(",", match.end(), end)
+        if key_end == -1 :
+          continue
+        key = bib[match.end():key_end].strip()
+        if key :
+          self.entries[key.decode("utf-8", "replace")] = extent
+
+  @staticmethod
+  def _entry_end(bib, start, opening) :
+    """Returns the offset after the delimiter closing an entry, or None."""
+    closing = opening == "{" and "}" or ")"
+    depth = 1
+    position = start
+    while depth :
+      next_opening, next_closing = bib.find(opening, position), bib.find(closing, position)
+      if next_closing == -1 :
+        return None
+      if next_opening != -1 and next_opening < next_closing :
+        depth, position = depth + 1, next_opening + 1
+      else :
+        depth, position = depth - 1, next_closing + 1
+    return position
+
+  def write_pruned(self, keys, filename) :
+    """Writes a .bib file holding only the entries for keys (and any entries
+    they crossref), plus the @string and @preamble definitions.  Returns the
+    keys that are not in the index."""
+    import re
+    bib = open(self.bib_filename, "rb")
+    def read(extent) :
+      bib.seek(extent[0])
+      return bib.read(extent[1])
+
+    try :
+      output = [read(extent) for extent in self.strings]
+      written, missing, crossrefs = set(), [], []
+      for key in keys :
+        if key in written :
+          continue
+        if key not in self.entries :
+          missing.append(key)
+          continue
+        entry = read(self.entries[key])
+        output.append(entry)
+        written.add(key)
+        crossrefs += [crossref.decode("utf-8", "replace") for crossref in re.findall(r"crossref\s*=\s*[{\"]\s*([^}\"\s]+)", entry, re.IGNORECASE)]
+
+      # BibTeX wants crossref'd entries after the entries referring to them.
+      for key in crossrefs :
+        if key not in written and key in self.entries :
+          output.append(read(self.entries[key]))
+          written.add(key)
+    finally :
+      bib.close()
+
+    write_if_changed(filename, "\n\n".join(output) + "\n")
+    return missing
+
+
+#################################################################
+# Extension modules
+#
+
+# Loaded extension modules, keyed on absolute path, so that we only import a
+# module again if it has changed on disk (e.g. in a long-running process).
+_extension_modules = {}
+
+def load_extension_module(module_file) :
+  """Imports an extension module by its path, reloading it if it has changed.
+
+  Returns a tuple of (module, translator_class, directive_classes), where
+  translator_class is None if the module does not define a LatexTranslator.
+  """
+  import os, sys, imp, hashlib
+  module_file = os.path.abspath(module_file)
+  mtime = os.path.getmtime(module_file)
+
+  cached = _extension_modules.get(module_file)
+  if cached and cached[0] == mtime :
+    return cached[1]
+
+  # Name the module after its path, so extensions with the same filename in
+  # different directories do not replace each other in sys.modules.
+  module_name = "rst_tex_extension_%s_%s" % (
+    os.path.splitext(os.path.basename(module_file))[0],
+    hashlib.md5(module_file.encode("utf-8")).hexdigest()[:8],
+  )
+  d("Loading extension module %s from %s" % (module_name, module_file))
+  # load_source would re-execute an edited module in its old namespace, keeping
+  # definitions that have since been removed, so load it afresh.
+  sys.modules.pop(module_name, None)
+  # Let the module import its neighbours (e.g. helpers) while it loads.
+  module_dir = os.path.dirname(module_file)
+  sys.path.insert(0, module_dir)
+  try :
+    module = imp.load_source(module_name, module_file)
+  finally :
+    sys.path.remove(module_dir)
+
+  translator_class = None
+  for item_name, item in module.__dict__.iteritems() :
+    if inspect.isclass(item) and issubclass(item, LatexTranslator) and item is not LatexTranslator :
+      translator_class = item
+      break
+
+  extension = (module, translator_class, find_directive_classes(module.__dict__))
+  _extension_modules[module_file] = (mtime, extension)
+  return extension
+
+def find_directive_classes(items) :
+  """Returns the WriterDirective subclasses in a dictionary of names (e.g. a module's)."""
+  return [item for item in items.values() if inspect.isclass(item) and issubclass(item, WriterDirective) and item is not WriterDirective]
+
 
 #################################################################
 # Translator
@@ -127,50 +976,225 @@ class Writer(writers.Writer):
 # which is very useful and saves lots of duplication.
 NODE_CONTENT = "__NODE_CONTENT__"
 
+def split_over_content(text) :
+  """Splits output around NODE_CONTENT into a (prefix, suffix) pair."""
+  parts = text.split(NODE_CONTENT)
+  if len(parts) > 1 :
+    return parts[0], parts[1]
+  return parts[0], ""
+
+# Split output of @precompiled handlers, by (translator class, handler name, key).
+_split_templates = {}
+
+def precompiled(handler=None, key=None) :
+  """Marks a write_* or role_* handler whose output depends only on the
+  translator class, or also on key(node) if a key function is given, so that
+  its output need only be built and split over NODE_CONTENT once.
+
+  Use as @precompiled or @precompiled(key=lambda node: ...).
+  """
+  def mark(handler) :
+    handler.precompiled_key = key or (lambda node: None)
+    return handler
+  if handler :
+    return mark(handler)
+  return mark
+
+class OutputBuffer(object) :
+  """A compact, append-only buffer for a document part.
+
+  Translators append very many small strings (single encoded characters,
+  braces, etc.), so rather than keep each as a list item, small appends are
+  coalesced into larger chunks once chunk_size characters have accumulated.
+  """
+
+  chunk_size = 4096
+
+  def __init__(self) :
+    self.chunks = []
+    self.pending = []
+    self.pending_size = 0
+
+  def append(self, s) :
+    self.pending.append(s)
+    self.pending_size += len(s)
+    if self.pending_size >= self.chunk_size :
+      self.flush()
+
+  def flush(self) :
+    """Merges pending appends into a single chunk."""
+    if self.pending :
+      self.chunks.append(''.join(self.pending))
+      self.pending = []
+      self.pending_size = 0
+
+  def getvalue(self) :
+    self.flush()
+    if len(self.chunks) > 1 :
+      self.chunks = [''.join(self.chunks)]
+    return self.chunks and self.chunks[0] or ""
+
+  def __iter__(self) :
+    self.flush()
+    return iter(self.chunks)
+
+
+
+# Text mappings and their targets sorted longest first, by (translator class,
+# minimal escaping), since they are fixed for both.
+_text_mapping_tables = {}
+
+# Templates split at their part placeholders, as {(filename, parts): (mtime,
+# pieces)}.  See compiled_template.
+_compiled_templates = {}
+
+def compiled_template(filename, parts) :
+  """Returns the template split into a list of its text, with the names of the
+  parts whose placeholders ([BODY], etc.) come between at odd indexes.  The
+  split is cached until the file changes."""
+  import os, re
+  key = (filename, tuple(parts))
+  mtime = os.path.getmtime(filename)
+  if key not in _compiled_templates or _compiled_templates[key][0] != mtime :
+    template = open(filename, "r").read()
+    placeholders = "|".join([re.escape("[%s]" % part.upper()) for part in parts])
+    pieces = re.split("(%s)" % placeholders, template)
+    pieces[1::2] = [placeholder[1:-1].lower() for placeholder in pieces[1::2]]
+    _compiled_templates[key] = (mtime, pieces)
+  return _compiled_templates[key][1]
+
+# Pairs of chars that latex fonts set as a ligature (dashes, quotes, etc.), and
+# the chars of those that are only escaped where they would form one, if the
+# writer asks for minimal escaping.
+LIGATURES = set(["--", "``", "''", ",,", "!`", "?`"])
+LIGATURE_CHARS = "-`',"
+
 class LatexTranslator(nodes.NodeVisitor):
   """As document nodes are visited, turns them into output for one or more document parts."""
 
   def __init__(self, document, writer):
     self.writer = writer
     nodes.NodeVisitor.__init__(self, document)
-    self.body = []
-    self.title = []
-    self.abstract = []
+    self.body = OutputBuffer()
+    self.title = OutputBuffer()
+    self.abstract = OutputBuffer()
     self.verbatim = False
     self.section_level = 0
     self.context_stack = []
     self.double_quote_state = 0 # For automatically opening and closing double quotes.
+    self.tables = [] # State of the tables we are in.  See visit_table.
+    self.highlight_styles_written = False
+    self.listing_styles = OutputBuffer() # Named listing styles.  See listing_style.
+    self.listing_style_names = {} # {option items: style name}
+    self.encoded_text = {} # Text node encodings, if batch encoded.  See visit_document.
+    self.directive_outputs = {} # Memoized directive output.  See directive_output.
+
+    # Counters, reported in render stats.
+    self.nodes_visited = 0
+    self.encode_calls = 0
+    self.encoded_chars = 0
+    self.batch_encoded_chars = 0
+    self.max_context_depth = 0
+    self.directive_memo_hits = 0
+    self.directive_memo_misses = 0
 
     # For handling switch between content parts
     self.part_stack = []
     self.current_part = self.body
 
 
-    # Initialise text mappings used for encoding text as latex.
-    self.text_mappings = self.initialise_text_mappings()
-    # Sorted so longest first, to allow for phrases to be replaced before
-    # individual chars.
-    self.sorted_mapping_targets = sorted(self.text_mappings.keys(), key=lambda target: len(target), reverse=True)
+    # Initialise text mappings used for encoding text as latex, once per class
+    # (and escaping mode), since that costs more than translating a snippet.
+    tables_key = (self.__class__, writer.minimal_escaping)
+    if tables_key not in _text_mapping_tables :
+      text_mappings = self.initialise_text_mappings()
+      if writer.minimal_escaping :
+        for char in LIGATURE_CHARS :
+          text_mappings.pop(char, None)
+      # Sorted so longest first, to allow for phrases to be replaced before
+      # individual chars.
+      sorted_mapping_targets = sorted(text_mappings.keys(), key=lambda target: len(target), reverse=True)
+      _text_mapping_tables[tables_key] = (text_mappings, sorted_mapping_targets)
+    self.text_mappings, self.sorted_mapping_targets = _text_mapping_tables[tables_key]
+
+    self.parts = ["body", "title", "abstract", "listing_styles"]
 
-    self.parts = ["body", "title", "abstract"]
+    # Top-level sections rendered separately, as (name, part), when the writer
+    # splits sections.
+    self.sections = []
 
 
 
   def astext(self):
     """Joins all parts into main doc string."""
-    output = open(self.writer.template, "r").read()
-    for part in self.parts :
-      try :
-        output = output.replace("[%s]" % part.upper(), ''.join(getattr(self, part)))
-      except AttributeError :
-        pass
+    template = compiled_template(self.writer.template, self.parts)
+
+    # Listing styles need only be defined before use, so templates without a
+    # place for them get them at the start of the body.
+    body_prefix = ""
+    if "listing_styles" not in template[1::2] :
+      body_prefix = self.part_text(self.listing_styles)
+
+    output = []
+    for index, text in enumerate(template) :
+      if index % 2 :
+        part = text
+        try :
+          text = self.part_text(getattr(self, part))
+        except AttributeError :
+          text = "[%s]" % part.upper()
+        if part == "body" :
+          text = body_prefix + text
+      output.append(text)
+
+    return ''.join(output)
+
+  def counters(self) :
+    """Returns counts of the work done, for render stats."""
+    return {
+      "nodes_visited": self.nodes_visited,
+      "encode_calls": self.encode_calls,
+      "encoded_chars": self.encoded_chars,
+      "batch_encoded_chars": self.batch_encoded_chars,
+      "max_context_depth": self.max_context_depth,
+      "directive_memo_hits": self.directive_memo_hits,
+      "directive_memo_misses": self.directive_memo_misses,
+    }
 
-    return output
+  def dispatch_visit(self, node) :
+    self.nodes_visited += 1
+    return nodes.NodeVisitor.dispatch_visit(self, node)
+
+  def part_text(self, part) :
+    """Returns the text of a part, which may be a buffer or a plain string."""
+    if isinstance(part, OutputBuffer) :
+      return part.getvalue()
+    return ''.join(part)
 
   def append(self, s, part="body") :
     """Adds a string to a part of the output."""
     self.current_part.append(s)
 
+  def add_dependency(self, filename, extensions=None) :
+    """Records a file the document depends on (e.g. an included image)."""
+    self.writer.add_dependency(filename, extensions)
+
+  def record_label(self, label, detail=None) :
+    """Records a label defined by the document in the writer's label index."""
+    self.writer.label_index.add_label(label, self.writer.source_name(), detail)
+
+  def record_ref(self, key) :
+    self.writer.label_index.add_ref(key, self.writer.source_name())
+
+  def record_cite(self, keys) :
+    """Records the keys of a (comma separated) citation."""
+    for key in keys.split(",") :
+      key = key.strip()
+      if key :
+        self.writer.label_index.add_cite(key, self.writer.source_name())
+        if key not in self.writer.cite_keys :
+          self.writer.cite_keys.append(key)
+
   def set_current_part(self, part) :
     if self.current_part is part :
       return
@@ -256,6 +1280,20 @@ class LatexTranslator(nodes.NodeVisitor):
     return text_mappings
 
 
+  def batch_encoder(self) :
+    """Returns a BatchEncoder for this translator's text mappings, or None if
+    batch encoding is not possible (no numpy, encode is overridden, or
+    escaping depends on context)."""
+    if self.__class__.encode.__func__ is not LatexTranslator.encode.__func__ or self.writer.minimal_escaping :
+      return None
+    if self.__class__ not in _batch_encoders :
+      try :
+        _batch_encoders[self.__class__] = BatchEncoder(self.text_mappings)
+      except ImportError :
+        d("numpy is not available, so not batch encoding text")
+        _batch_encoders[self.__class__] = None
+    return _batch_encoders[self.__class__]
+
   def encode(self, text, verbatim=False) :
     """Encodes a piece of unicode text as latex, replacing chars and phrases with the text_mappings."""
     if self.verbatim :
@@ -264,8 +1302,12 @@ class LatexTranslator(nodes.NodeVisitor):
     if verbatim :
       return text
 
+    self.encode_calls += 1
+    self.encoded_chars += len(text)
+
     # Allow for phrase substitution.
     latex_text = []
+    unmapped_ligature_chars = [] # Indexes in latex_text.  See brace_ligatures.
     while text :
       latex_term = None
       
@@ -286,10 +1328,26 @@ class LatexTranslator(nodes.NodeVisitor):
       if not latex_term :
         latex_term = text[0]
         text = text[1:] # Reduce text
+        if latex_term in LIGATURE_CHARS and self.writer.minimal_escaping :
+          unmapped_ligature_chars.append(len(latex_text))
       latex_text.append(latex_term)
+
+    if unmapped_ligature_chars :
+      self.brace_ligatures(latex_text, unmapped_ligature_chars)
     
     return ''.join(latex_text)
 
+  def brace_ligatures(self, latex_text, indexes) :
+    """Braces the unmapped chars at indexes of latex_text that would form a
+    ligature with their neighbour, or that start or end the text, where we do
+    not know the neighbour."""
+    for index in indexes :
+      char = latex_text[index]
+      before = index > 0 and latex_text[index - 1][-1:]
+      after = index + 1 < len(latex_text) and latex_text[index + 1][:1]
+      if not before or not after or before + char in LIGATURES or char + after in LIGATURES :
+        latex_text[index] = "{%s}" % char
+
   #
   # Latex shortcuts
   #
@@ -319,6 +1377,16 @@ class LatexTranslator(nodes.NodeVisitor):
   def surround_content(self, prefix, suffix, content=NODE_CONTENT) :
     return prefix + content + suffix
 
+  def listing_style(self, options) :
+    """Returns the name of a listing style with the given options, defining it
+    once, in the listing_styles part, the first time those options are used."""
+    key = tuple(sorted(options.items()))
+    if key not in self.listing_style_names :
+      name = "rsttex%d" % (len(self.listing_style_names) + 1)
+      self.listing_style_names[key] = name
+      self.listing_styles.append("\\lstdefinestyle{%s}{%s}\n" % (name, self.dict_to_latex_options(options)))
+    return self.listing_style_names[key]
+
   def dict_to_latex_options(self, options) :
     return ",".join(["%s=%s" % (option,value) for option, value in options.iteritems()])
 
@@ -331,12 +1399,52 @@ class LatexTranslator(nodes.NodeVisitor):
 
   def split_and_push(self, text): 
     """Splits output over node content, so second part can be popped off stack on depart."""
-    parts = text.split(NODE_CONTENT)
+    self.push_split(split_over_content(text))
+
+  def push_split(self, split_text) :
+    """Appends the prefix of a (prefix, suffix) pair, pushing the suffix for depart."""
+    prefix, suffix = split_text
+    self.context_stack.append(suffix)
+    if len(self.context_stack) > self.max_context_depth :
+      self.max_context_depth = len(self.context_stack)
+    self.append(prefix)
+
+  def push_handler(self, name, node) :
+    """Splits and pushes the output of a write_* or role_* handler.
+
+    Output of handlers marked @precompiled is split once per translator class
+    (and key), then reused.
+    """
+    handler = getattr(self, name)
+    key = getattr(handler, "precompiled_key", None)
+    if key is None :
+      self.split_and_push(handler(node))
+      return
+
+    template_key = (self.__class__, name, key(node))
+    split_text = _split_templates.get(template_key)
+    if split_text is None :
+      split_text = _split_templates[template_key] = split_over_content(handler(node))
+    self.push_split(split_text)
+
+  def directive_output(self, directive, node) :
+    """Returns the output of a directive's write for node, reusing that for an
+    earlier node with the same args and options if the writer memoizes."""
+    if not (self.writer.memoize_directives and directive.memoize) :
+      return directive.write(self, node)
+
+    key = (directive, tuple(node.args), tuple([getattr(node, option, None) for option in sorted(directive.option_spec)]))
     try :
-      self.context_stack.append(parts[1])
-    except :
-      self.context_stack.append("")
-    self.append(parts[0])
+      output = self.directive_outputs.get(key)
+    except TypeError : # Unhashable option values
+      return directive.write(self, node)
+
+    if output is None :
+      self.directive_memo_misses += 1
+      output = self.directive_outputs[key] = directive.write(self, node)
+    else :
+      self.directive_memo_hits += 1
+    return output
 
   def pop_context(self) :
     """Pops from the stack to the body."""
@@ -349,19 +1457,44 @@ class LatexTranslator(nodes.NodeVisitor):
 
   def visit_title(self, node) :
     """Use this only for the main document title, since our sections write the title."""
+    if isinstance(node.parent, nodes.table) :
+      raise nodes.SkipNode # Written as the table's caption.
     if self.section_level == 0 :
       self.title = self.encode(node.astext())
     raise nodes.SkipNode
 
+  def visit_document(self, node) :
+    # Encode all text in one go, if the writer asks for it.
+    self.encoded_text = {}
+    if self.writer.batch_encode :
+      encoder = self.batch_encoder()
+      if encoder :
+        text_nodes = node.traverse(nodes.Text)
+        texts = [text_node.astext() for text_node in text_nodes]
+        encoded_text = encoder.encode_many(texts)
+        self.batch_encoded_chars += sum([len(text) for text in texts])
+        self.encoded_text = dict(zip([id(text_node) for text_node in text_nodes], encoded_text))
+
+    # Let directives prepare their nodes in bulk (e.g. to do work in parallel).
+    directive_nodes = {}
+    for directive_node in node.traverse(GenericNode) :
+      if hasattr(directive_node, "directive") and hasattr(directive_node.directive, "prepare") :
+        directive_nodes.setdefault(directive_node.directive, []).append(directive_node)
+    for directive, nodes_to_prepare in directive_nodes.items() :
+      directive.prepare(self, nodes_to_prepare)
+
   def visit_Text(self, node):
     """Simple text node."""
-    self.append(self.encode(node.astext()))
+    latex_text = self.encoded_text.pop(id(node), None)
+    if latex_text is None or self.verbatim :
+      latex_text = self.encode(node.astext())
+    self.append(latex_text)
  
 
   def visit_raw(self, node):
     """Adds raw text directly to output."""
-    if hasattr(node, "role_name") :
-      role_function = getattr(self, "raw_role_%s" % node.role_name)
+    if "role_name" in node :
+      role_function = getattr(self, "raw_role_%s" % node["role_name"])
       self.append(role_function(node))
     
     raise nodes.SkipNode # So we don't descend further into the node.
@@ -384,6 +1517,13 @@ class LatexTranslator(nodes.NodeVisitor):
 
     # Increase the section level.
     self.section_level += 1
+
+    # Render top-level sections to their own part, if splitting them.
+    if self.writer.split_sections and self.section_level == 1 and title_text.lower().strip() != "abstract" :
+      node.split_name = "%s%d" % (self.writer.split_sections, len(self.sections) + 1)
+      section_part = OutputBuffer()
+      self.sections.append((node.split_name, section_part))
+      self.set_current_part(section_part)
     
     # Add the section to give us more flexibility in processing sections.
     self.visit_titled_section(title_text, node)
@@ -397,6 +1537,10 @@ class LatexTranslator(nodes.NodeVisitor):
     
     # Add the section to give us more flexibility in processing sections.
     self.depart_titled_section(title_text, node)
+
+    if hasattr(node, "split_name") :
+      self.unset_current_part()
+      self.append("\n\\input{%s}\n" % node.split_name)
     
     # Decrese the section level.
     self.section_level -= 1
@@ -443,25 +1587,32 @@ class LatexTranslator(nodes.NodeVisitor):
   # content
   #
 
+  @precompiled
   def write_paragraph(self, node) :
     return self.surround_content("\n","\n")
   
+  @precompiled
   def write_emphasis(self, node) :
     return self.latex_command("emph")
 
+  @precompiled
   def write_strong(self, node) :
     return self.latex_command("textbf")
     
   def write_cite(self, node) :
+    self.record_cite(node.astext())
     return self.latex_command("cite")
 
+  @precompiled
   def write_bullet_list(self, node) :
     return self.begin_end("itemize")
  
 
+  @precompiled
   def write_enumerated_list(self, node) :
     return self.begin_end("enumerate")
 
+  @precompiled
   def write_list_item(self, node) :
     return self.latex_command("item")
 
@@ -471,16 +1622,20 @@ class LatexTranslator(nodes.NodeVisitor):
   #    # Need \usepackage{hyperref}
   #    return self.latex_command("url", )
 
+  @precompiled
   def write_definition_list(self, node) :
     return self.begin_end("description")
  
+  @precompiled
   def write_definition(self, node) :
     return ""
     return self.latex_command("item", content=None, args=NODE_CONTENT)
 
+  @precompiled
   def write_term(self, node) :
     return self.latex_command("item", content=None, args=NODE_CONTENT)
   
+  @precompiled
   def write_definition_list_item(self, node) :
     return self.surround_content("{","}")
 
@@ -491,24 +1646,27 @@ class LatexTranslator(nodes.NodeVisitor):
 
 
   def visit_inline(self, node) :
-    if hasattr(node, "role_name") :
-      role_function = getattr(self, "role_%s" % node.role_name)
-      self.split_and_push(role_function(node))
+    if "role_name" in node :
+      self.push_handler("role_%s" % node["role_name"], node)
 
   def depart_inline(self, node) :
-    if hasattr(node, "role_name") :
+    if "role_name" in node :
       self.pop_context()
 
     
+  @precompiled
   def role_footnote(self, node) :
     return self.latex_command("footnote")
 
+  @precompiled
   def role_quote(self, node) :
     return "`" + NODE_CONTENT + "'"
   
+  @precompiled
   def role_dquote(self, node) :
     return "``" + NODE_CONTENT + "\""
 
+  @precompiled
   def role_code(self, node) :
     return self.set_colour("blue", self.latex_command("texttt"))
 
@@ -520,9 +1678,11 @@ class LatexTranslator(nodes.NodeVisitor):
   raw_role_hyperlink = raw_role_url # url doesn't seem to work
 
   def raw_role_cite(self, node) :
+    self.record_cite(node.astext())
     return self.latex_command("cite", node.astext())
   
   def raw_role_label(self, node) :
+    self.record_label(node.astext())
     return self.latex_command("label", node.astext())
   
   def raw_role_latex(self, node) :
@@ -530,9 +1690,118 @@ class LatexTranslator(nodes.NodeVisitor):
     return node.astext()
   
   def raw_role_ref(self, node) :
+    self.record_ref(node.astext())
     return self.latex_command("ref", node.astext())
   
 
+  #
+  # Tables, written as longtables (needs the longtable latex package), so that
+  # they may run over pages.  Rows are appended to the output as they are
+  # visited.
+  #
+
+  def visit_table(self, node) :
+    caption = None
+    if len(node) and isinstance(node[0], nodes.title) :
+      caption = self.encode(node[0].astext())
+    self.tables.append({
+      "caption": caption,
+      "widths": [],     # Fraction of the line width of each column.
+      "column": 0,      # Column of the next entry in the current row.
+      "row_spans": {},  # Column -> rows still covered by an entry above.
+    })
+
+  def depart_table(self, node) :
+    self.tables.pop()
+    self.append("\\end{longtable}\n\n")
+
+  def visit_tgroup(self, node) :
+    table = self.tables[-1]
+
+    # Work out the column spec once, from the relative column widths.
+    widths = [colspec.get("colwidth", 1) for colspec in node.children if isinstance(colspec, nodes.colspec)]
+    table["widths"] = self.column_widths(widths)
+    self.append(self.begin_longtable(table["widths"], table["caption"]))
+
+  def depart_tgroup(self, node) : pass
+
+  def column_widths(self, widths) :
+    """Scales relative column widths to fractions of the line width."""
+    total_width = float(sum(widths)) or 1.0
+    return [0.9 * width / total_width for width in widths]
+
+  def begin_longtable(self, widths, caption=None) :
+    """Returns the start of a longtable with columns of the given widths (as
+    fractions of the line width) and an optional (encoded) caption."""
+    column_spec = "|%s|" % "|".join(["p{%.3f\\linewidth}" % width for width in widths])
+    output = "\n\n\\begin{longtable}{%s}\n" % column_spec
+    if caption :
+      output += "\\caption{%s}\\\\\n" % caption
+    return output + "\\hline\n"
+
+  def visit_colspec(self, node) :
+    raise nodes.SkipNode
+
+  def visit_thead(self, node) : pass
+
+  def depart_thead(self, node) :
+    # Repeat the header rows on each page.
+    self.append("\\endhead\n")
+
+  def visit_tbody(self, node) : pass
+  def depart_tbody(self, node) : pass
+
+  def visit_row(self, node) :
+    self.tables[-1]["column"] = 0
+
+  def depart_row(self, node) :
+    table = self.tables[-1]
+    self.write_spanned_cells(table, len(table["widths"]))
+
+    # Rule off the row, except under columns an entry continues into.
+    row_spans = table["row_spans"]
+    ruled_columns = [column for column in range(len(table["widths"])) if not row_spans.get(column)]
+    if len(ruled_columns) == len(table["widths"]) :
+      self.append(" \\\\ \\hline\n")
+    else :
+      self.append(" \\\\ %s\n" % "".join(["\\cline{%d-%d}" % (column + 1, column + 1) for column in ruled_columns]))
+
+  def visit_entry(self, node) :
+    table = self.tables[-1]
+    self.write_spanned_cells(table, table["column"] + 1)
+    column = table["column"]
+    if column > 0 :
+      self.append(" & ")
+
+    # Note the columns this entry covers in the rows below.
+    morecols, morerows = node.get("morecols", 0), node.get("morerows", 0)
+    if morerows :
+      for spanned_column in range(column, column + morecols + 1) :
+        table["row_spans"][spanned_column] = morerows
+
+    if morecols :
+      width = sum(table["widths"][column:column + morecols + 1])
+      # The column before has drawn the rule on our left, unless we are first.
+      left_rule = column == 0 and "|" or ""
+      self.push_split(("\\multicolumn{%d}{%sp{%.3f\\linewidth}|}{" % (morecols + 1, left_rule, width), "}"))
+    else :
+      self.push_split(("", ""))
+    table["column"] = column + morecols + 1
+
+  def depart_entry(self, node) :
+    self.pop_context()
+
+  def write_spanned_cells(self, table, end_column) :
+    """Writes empty cells for columns, up to end_column, covered by entries in
+    the rows above."""
+    row_spans = table["row_spans"]
+    while table["column"] < end_column and row_spans.get(table["column"]) :
+      column = table["column"]
+      row_spans[column] -= 1
+      if column > 0 :
+        self.append(" & ")
+      table["column"] = column + 1
+
 
   #
   # Ignored nodes
@@ -540,7 +1809,6 @@ class LatexTranslator(nodes.NodeVisitor):
   def visit_ignore(self, node) : pass
   def visit_ignore_and_skip(self, node) : raise nodes.SkipNode # So we don't descend further into the node.
   
-  visit_document = visit_ignore
   visit_subtitle = visit_ignore
   visit_reference = visit_ignore
   visit_comment = visit_ignore_and_skip
@@ -565,7 +1833,7 @@ class LatexTranslator(nodes.NodeVisitor):
     class_name = node.__class__.__name__
     write_function = "write_%s" % class_name
     if hasattr(self, write_function) :
-      self.split_and_push(getattr(self, write_function)(node))
+      self.push_handler(write_function, node)
       return
 
     # Our directive nodes encapsulate their writer functions.
@@ -603,13 +1871,150 @@ class LatexTranslator(nodes.NodeVisitor):
 
 
 
+###############################
+# Batch text encoding
+#
+
+# BatchEncoders by translator class, since text mappings are fixed per class.
+_batch_encoders = {}
+
+class BatchEncoder(object) :
+  """Encodes many pieces of text at once, giving the same results as
+  LatexTranslator.encode.
+
+  Rather than try every mapping target at every character, numpy finds the
+  positions where a target can match: characters with a single-character
+  mapping, via a lookup table indexed by codepoint, and the starts of phrase
+  targets, by comparing shifted codepoint arrays.  Only those positions go
+  through the (scalar) longest-first matcher; the text between them is copied
+  as is.
+  """
+
+  def __init__(self, text_mappings) :
+    import numpy
+    self.numpy = numpy
+    self.text_mappings = text_mappings
+
+    # Targets by first character, longest first, as in LatexTranslator.encode.
+    self.targets_by_first_char = {}
+    for target in sorted(text_mappings.keys(), key=lambda target: len(target), reverse=True) :
+      self.targets_by_first_char.setdefault(target[0], []).append(target)
+
+    single_chars = [ord(target) for target in text_mappings if len(target) == 1]
+    self.char_table = numpy.zeros(max(single_chars) + 1, dtype=bool)
+    self.char_table[single_chars] = True
+
+    self.phrases = [self.codepoints(target) for target in text_mappings if len(target) > 1]
+
+  def codepoints(self, text) :
+    """Returns the text as an array with an item per (python) character."""
+    import sys
+    numpy = self.numpy
+    if sys.maxunicode > 0xffff :
+      return numpy.frombuffer(text.encode("utf-32-le"), dtype="<u4")
+    return numpy.frombuffer(text.encode("utf-16-le"), dtype="<u2")
+
+  def encode_many(self, texts) :
+    """Encodes a list of texts, returning a list of latex strings."""
+    numpy = self.numpy
+    texts = [unicode(text) for text in texts]
+    text = u"".join(texts)
+    codes = self.codepoints(text)
+    length = len(codes)
+
+    # Flag positions where a single-character mapping applies...
+    candidates = numpy.zeros(length, dtype=bool)
+    in_table = codes < len(self.char_table)
+    candidates[in_table] = self.char_table[codes[in_table]]
+
+    # ...or where a phrase starts.  Phrases crossing from one text into the next
+    # are weeded out by the matcher.
+    for phrase in self.phrases :
+      span = length - len(phrase) + 1
+      if span <= 0 :
+        continue
+      matches = codes[:span] == phrase[0]
+      for offset in range(1, len(phrase)) :
+        matches &= codes[offset:span + offset] == phrase[offset]
+      candidates[:span] |= matches
+
+    positions = numpy.flatnonzero(candidates)
+
+    # Encode each text from its candidate positions.
+    encoded_texts = []
+    start = 0
+    for piece in texts :
+      end = start + len(piece)
+      latex_text = []
+      cursor = start
+      for position in positions[positions.searchsorted(start):positions.searchsorted(end)] :
+        if position < cursor : # Inside a phrase we already replaced.
+          continue
+        latex_text.append(text[cursor:position])
+        latex_term, cursor = self.match(text, position, end)
+        latex_text.append(latex_term)
+      latex_text.append(text[cursor:end])
+      encoded_texts.append(u"".join(latex_text))
+      start = end
+
+    return encoded_texts
+
+  def match(self, text, position, end) :
+    """Returns the latex for the longest target at position, and where it ends."""
+    for target in self.targets_by_first_char.get(text[position], []) :
+      if text.startswith(target, position, end) :
+        return self.text_mappings[target], position + len(target)
+    return text[position], position + 1
+
+
+###############################
+# Output helpers
+#
+
+def write_if_changed(filename, content, encoding="latin-1") :
+  """Writes content to a file only if it differs from what is there already.
+
+  Leaving an unchanged file untouched preserves its mtime, so that make,
+  latexmk, etc. do not rebuild from it.  Returns True if the file was written.
+  """
+  import os
+  if isinstance(content, unicode) :
+    content = content.encode(encoding)
+
+  if os.path.exists(filename) and os.path.getsize(filename) == len(content) :
+    existing = open(filename, "rb").read()
+    if existing == content :
+      d("Not writing unchanged %s" % filename)
+      return False
+
+  open(filename, "wb").write(content)
+  return True
+
+
+def write_dependency_file(filename, targets, dependencies) :
+  """Writes a make-style dependency (.d) file, as understood by make, ninja, etc.
+
+  As with gcc -MP, each dependency also gets an empty rule, so that make does
+  not fail if one is later deleted.
+  """
+  def escape(path) :
+    return path.replace("$", "$$").replace("#", "\\#").replace(" ", "\\ ")
+
+  lines = ["%s: %s" % (" ".join([escape(target) for target in targets]), " \\\n  ".join([escape(dependency) for dependency in dependencies]))]
+  for dependency in dependencies :
+    lines.append("\n%s:" % escape(dependency))
+
+  return write_if_changed(filename, "\n".join(lines) + "\n")
+
+
 ###############################
 # Generic role generators.
 #
 
 def generic_inline_role(role, rawtext, text, lineno, inliner, options={}, content=[]):
   node = nodes.inline(rawtext, utils.unescape(text), **options)
-  node.role_name = role
+  # Kept as an attribute, so copies of the node (e.g. of an included file) keep it.
+  node["role_name"] = role
   return [node], []
 
 def generic_raw_role(role, rawtext, text, lineno, inliner, options={}, content=[]):
@@ -617,7 +2022,7 @@ def generic_raw_role(role, rawtext, text, lineno, inliner, options={}, content=[
   # docutils sets literal backslash to \x00 in text, so undo this for literal output.
   text = text.replace("\x00","\\")
   node = nodes.raw(rawtext, text, **options)
-  node.role_name = role
+  node["role_name"] = role
   return [node], []
 
 
@@ -630,7 +2035,19 @@ def generic_raw_role(role, rawtext, text, lineno, inliner, options={}, content=[
 # directives and their writer code.
 
 # A node for general use.
-class GenericNode(nodes.comment): pass
+class GenericNode(nodes.comment):
+
+  def copy(self):
+    # Keep the attributes directives store on the node (directive, args, etc.).
+    copy = nodes.comment.copy(self)
+    for name, value in self.__dict__.items() :
+      if name not in copy.__dict__ and name not in ["parent", "document"] :
+        setattr(copy, name, value)
+    return copy
+
+# How a WriterDirective's content is parsed.  See WriterDirective.content_parsing.
+PARSE_FIRST_PARAGRAPH = "first_paragraph"
+PARSE_ALL_CONTENT = "all_content"
 
 class WriterDirective(Directive) :
   
@@ -639,6 +2056,11 @@ class WriterDirective(Directive) :
   final_argument_whitespace = False
   option_spec = { }
   has_content = True
+
+  # PARSE_FIRST_PARAGRAPH parses only the first block of the content, keeping
+  # it if it is a paragraph (e.g. a caption); PARSE_ALL_CONTENT parses it all
+  # into the node; None leaves the content unparsed.
+  content_parsing = PARSE_FIRST_PARAGRAPH
   
   # See here: http://docutils.sourceforge.net/docs/howto/rst-directives.html
   def _create_node(self, parse_content=True) :
@@ -646,12 +2068,15 @@ class WriterDirective(Directive) :
     node = GenericNode()
     
     # If the directive has content, we will want to run it through the parser.
-    if parse_content and self.content :
-      nnode = nodes.Element()          # anonymous container for parsing
-      self.state.nested_parse(self.content, self.content_offset, nnode)
-      first_node = nnode[0]
-      if isinstance(first_node, nodes.paragraph):
-        node += first_node
+    if parse_content and self.content_parsing and self.content :
+      if self.content_parsing == PARSE_ALL_CONTENT :
+        self.state.nested_parse(self.content, self.content_offset, node)
+      else :
+        start, end = self._first_block()
+        nnode = nodes.Element()          # anonymous container for parsing
+        self.state.nested_parse(self.content[start:end], self.content_offset + start, nnode)
+        if len(nnode) and isinstance(nnode[0], nodes.paragraph):
+          node += nnode[0]
         
     # Automatically store any labelled options on the node
     for key in self.option_spec.keys() :
@@ -662,6 +2087,23 @@ class WriterDirective(Directive) :
     node.directive = self.__class__
     
     return node
+
+  def _first_block(self) :
+    """Returns the (start, end) lines of the first block of the content, so only
+    that need be parsed for its first paragraph."""
+    lines = list(self.content)
+    start = 0
+    while start < len(lines) and not lines[start].strip() :
+      start += 1
+    end = start
+    while end < len(lines) and lines[end].strip() :
+      end += 1
+
+    # A paragraph ending "::" expects the literal block after it.
+    if end > start and lines[end-1].rstrip().endswith("::") :
+      end = len(lines)
+
+    return start, end
  
   # Note, can define a write method if content is automatically to be split over a node
   """
@@ -671,10 +2113,22 @@ class WriterDirective(Directive) :
     return output
   """
 
+  # Whether, if the writer memoizes directives, write's output for a node may
+  # be reused for later nodes with the same args and options.  Set False if it
+  # depends on anything else (e.g. writer state).  What the node records with
+  # the writer (dependencies, labels, etc.) belongs in record, which is always
+  # called.
+  memoize = True
+
+  @staticmethod
+  def record(writer, node):
+    pass
+
   @classmethod
   def visit(cls, writer, node):
     if hasattr(cls, "write") :
-      writer.split_and_push(cls.write(writer, node))
+      cls.record(writer, node)
+      writer.split_and_push(writer.directive_output(cls, node))
       return
     raise NotImplementedError
 
@@ -689,6 +2143,9 @@ class WriterDirective(Directive) :
 # Directives
 #
 
+# Extensions latex tries for an \includegraphics filename given without one.
+GRAPHICS_EXTENSIONS = [".pdf", ".png", ".jpg", ".jpeg", ".eps", ".ps"]
+
 class image(WriterDirective):
 
   required_arguments = 1 # Filename
@@ -704,6 +2161,11 @@ class image(WriterDirective):
     # Use filename as label.
     node.label = os.path.basename(node.filename).split(".")[0]
     return [node]
+
+  @staticmethod
+  def record(writer, node):
+    writer.add_dependency(node.filename, GRAPHICS_EXTENSIONS)
+    writer.record_label(node.label, node.filename)
  
   @staticmethod
   def write(writer, node):
@@ -743,8 +2205,35 @@ class image(WriterDirective):
     return output
  
 
+# Highlighted listings by key (of content, language and pygments version).
+_highlighted_listings = {}
+
+def listing_lexer_name(filename, language) :
+  """Returns the name of the pygments lexer for a listing: that for its
+  language, if given, else that for its filename (and content)."""
+  from pygments import lexers, util
+  try :
+    if language :
+      return lexers.get_lexer_by_name(language).name
+    code = open(filename, "rb").read().decode("utf-8", "replace")
+    return lexers.get_lexer_for_filename(filename, code).name
+  except util.ClassNotFound :
+    return lexers.TextLexer.name
+
+def highlight_listing(job) :
+  """Highlights a (filename, lexer name) listing with pygments, returning latex.
+
+  This is a module function so that worker processes can run it.
+  """
+  filename, lexer_name = job
+  from pygments import highlight, lexers
+  from pygments.formatters import LatexFormatter
+  code = open(filename, "rb").read().decode("utf-8", "replace")
+  return highlight(code, lexers.find_lexer_class(lexer_name)(), LatexFormatter())
+
 class literal_include(WriterDirective):
-  """Requires listings latex package."""
+  """Requires listings latex package, or fancyvrb and color if the writer
+  highlights listings itself."""
 
   required_arguments = 1 # filename
   option_spec = {
@@ -758,10 +2247,74 @@ class literal_include(WriterDirective):
     # Use filename as label.
     node.label = os.path.basename(node.filename).split(".")[0]
     return [node]
+
+  @classmethod
+  def prepare(cls, writer, directive_nodes) :
+    """Highlights the document's listings with pygments, if the writer asks for
+    it, so that latex need not.  Highlighting is cached by content and done in
+    parallel."""
+    if not writer.writer.highlight_listings :
+      return
+    try :
+      import pygments
+    except ImportError :
+      d("pygments is not available, so not highlighting listings")
+      return
+    import hashlib
+
+    cache = None
+    if writer.writer.highlight_cache_dir :
+      cache = DirectoryCache(writer.writer.highlight_cache_dir)
+
+    # Find the listings we have not highlighted before.
+    jobs = {}
+    for node in directive_nodes :
+      if "verbatim" in node.args :
+        continue
+      try :
+        content_hash = file_hash(node.filename)
+      except IOError :
+        continue
+      writer.writer.content_dependencies[node.filename] = content_hash
+      # Without a language, the lexer depends on the filename too.
+      lexer_name = listing_lexer_name(node.filename, node.language)
+      node.highlight_key = hashlib.sha1("%s\0%s\0%s" % (content_hash, lexer_name, pygments.__version__)).hexdigest()
+      if node.highlight_key not in _highlighted_listings and cache :
+        cached = cache.get(node.highlight_key)
+        if cached :
+          _highlighted_listings[node.highlight_key] = cached.decode("utf-8")
+      if node.highlight_key not in _highlighted_listings :
+        jobs[node.highlight_key] = (node.filename, lexer_name)
+
+    # Daemonic processes (e.g. render_many's workers) cannot have a pool.
+    import multiprocessing
+    keys = jobs.keys()
+    if len(keys) > 1 and not multiprocessing.current_process().daemon :
+      pool = multiprocessing.Pool(min(len(keys), multiprocessing.cpu_count()))
+      try :
+        results = pool.map(highlight_listing, [jobs[key] for key in keys])
+      finally :
+        pool.close()
+        pool.join()
+    else :
+      results = [highlight_listing(jobs[key]) for key in keys]
+
+    for key, latex in zip(keys, results) :
+      _highlighted_listings[key] = latex
+      if cache :
+        cache.set(key, latex.encode("utf-8"))
+
+    for node in directive_nodes :
+      if hasattr(node, "highlight_key") :
+        node.highlighted = _highlighted_listings[node.highlight_key]
  
+  @staticmethod
+  def record(writer, node):
+    writer.add_dependency(node.filename)
+    writer.record_label(node.label, node.filename)
+
   @staticmethod
   def write(writer, node):
-    
     begin_end, latex_command = writer.begin_end, writer.latex_command
 
     # Allow for simple verbatim inclusion
@@ -784,9 +2337,15 @@ class literal_include(WriterDirective):
       options["language"] = node.language
     
     
-    output += latex_command("lstset", writer.dict_to_latex_options(options))
-
-    listing_command = latex_command("lstinputlisting", node.filename)
+    if getattr(node, "highlighted", None) :
+      # Pre-coloured by pygments, which needs its style commands defined once.
+      if not writer.highlight_styles_written :
+        from pygments.formatters import LatexFormatter
+        writer.listing_styles.append("%s\n" % LatexFormatter().get_style_defs())
+        writer.highlight_styles_written = True
+      listing_command = node.highlighted
+    else :
+      listing_command = "\\lstinputlisting[style=%s]{%s}" % (writer.listing_style(options), node.filename)
   
     if "span_columns" in node.args :
       figure_env = "figure*"
@@ -812,3 +2371,230 @@ class literal_include(WriterDirective):
     return output
 
 
+class csv_table(WriterDirective):
+  """Writes a CSV file as a longtable, streaming it a row at a time, so neither
+  the file nor docutils nodes for its cells are ever held in memory."""
+
+  required_arguments = 1 # filename
+  content_parsing = None
+  option_spec = {
+    'columns': directives.unchanged, # Comma separated column numbers (from 1), or names if there is a header.
+    'max_rows': directives.nonnegative_int,
+    'header': directives.flag, # The first row is a header, repeated on each page.
+    'caption': directives.unchanged,
+    'delimiter': directives.unchanged,
+    'encoding': directives.unchanged,
+  }
+
+  def run(self):
+    node = self._create_node()
+    node.filename = node.args[0]
+    node.header = "header" in self.options
+    return [node]
+
+  @classmethod
+  def visit(cls, writer, node):
+    import csv, itertools
+    writer.add_dependency(node.filename)
+    try :
+      csv_file = open(node.filename, "rb")
+    except IOError, e :
+      writer._warning("[Cannot read %s: %s]" % (node.filename, e.strerror))
+      raise nodes.SkipNode
+    # The output includes the file's content, so a cached render is stale if it changes.
+    writer.writer.content_dependencies[node.filename] = file_hash(node.filename)
+
+    try :
+      rows = csv.reader(csv_file, delimiter=str(node.delimiter or ","))
+      header = None
+      if node.header :
+        header = next(rows, [])
+
+      try :
+        columns = cls.select_columns(node.columns, header)
+      except ValueError, e :
+        writer._warning("[%s]" % e)
+        raise nodes.SkipNode
+
+      if columns is None :
+        first_row = header or next(rows, [])
+        columns = range(len(first_row))
+        if not header :
+          rows = itertools.chain([first_row], rows)
+      if not columns :
+        writer._warning("[%s has no columns]" % node.filename)
+        raise nodes.SkipNode
+
+      caption = node.caption and writer.encode(node.caption)
+      writer.append(writer.begin_longtable(writer.column_widths([1] * len(columns)), caption))
+      if header :
+        cls.write_row(writer, node, header, columns)
+        writer.append("\\endhead\n")
+
+      for row_number, row in enumerate(rows) :
+        if node.max_rows is not None and row_number >= node.max_rows :
+          break
+        cls.write_row(writer, node, row, columns)
+      writer.append("\\end{longtable}\n\n")
+    finally :
+      csv_file.close()
+
+    raise nodes.SkipNode
+
+  @staticmethod
+  def select_columns(columns, header) :
+    """Returns the indexes of the columns option's columns, or None for all."""
+    if not columns :
+      return None
+    indexes = []
+    for column in columns.split(",") :
+      column = column.strip()
+      if column.isdigit() and int(column) >= 1 :
+        indexes.append(int(column) - 1)
+      elif header and column in header :
+        indexes.append(header.index(column))
+      else :
+        raise ValueError("csv_table has no column '%s'" % column)
+    return indexes
+
+  @staticmethod
+  def write_row(writer, node, row, columns):
+    encoding = node.encoding or "utf-8"
+    cells = []
+    for column in columns :
+      if column < len(row) :
+        cells.append(writer.encode(row[column].decode(encoding)))
+      else :
+        cells.append("")
+    writer.append(" & ".join(cells))
+    writer.append(" \\\\ \\hline\n")
+
+
+# Parses of included files, as {filename: (content hash, container node)}.
+_included_parses = {}
+
+class rst_include(WriterDirective):
+  """Includes another rst file's content here.
+
+  The file is parsed on its own, so its title styles are its own: its top
+  sections nest under the section the directive is in (e.g. they are
+  \\subsection's within a section), whatever their adornment.  Include
+  chapters from outside any section to have them as top-level sections.
+
+  Each file's parse is cached by content hash, so an
+  edited file is the only one re-parsed.  Includes within an included file are
+  left as placeholders in its cached parse and expanded when it is included.
+  The files included by each file are recorded in document.include_graph.
+  """
+
+  required_arguments = 1 # filename
+  content_parsing = None
+
+  def run(self):
+    import os
+    source = self.state_machine.input_lines.source(self.lineno - self.state_machine.input_offset - 1)
+    # Paths are relative to the including file, as given to us (so like the
+    # source filename in dependency files).
+    node = self._create_node()
+    node.filename = os.path.normpath(os.path.join(os.path.dirname(source or ""), node.args[0]))
+    node.including = source and os.path.normpath(source)
+    node.error = None
+
+    # Within a parse of an included file, leave the include to be expanded.
+    document = self.state.document
+    if getattr(document, "include_parse", False) :
+      return [node]
+
+    expansion = self.expand(document, node, [node.including])
+    for child in expansion :
+      self.note_nodes(document, child)
+    return expansion
+
+  @classmethod
+  def expand(cls, document, node, stack):
+    """Returns the nodes to replace an include placeholder with, recursively
+    expanding those in the included file."""
+    if not hasattr(document, "include_graph") :
+      document.include_graph = {}
+    included = document.include_graph.setdefault(node.including, [])
+    if node.filename not in included :
+      included.append(node.filename)
+
+    if node.filename in stack :
+      node.error = "Include cycle: %s" % " -> ".join([filename for filename in stack if filename] + [node.filename])
+      return [node]
+
+    try :
+      container = cls.parse(document, node.filename)
+    except IOError, e :
+      node.error = "Cannot include %s: %s" % (node.filename, e.strerror)
+      return [node]
+
+    # Replace the copy's placeholders with what they include.
+    content = container.deepcopy()
+    for placeholder in content.traverse(lambda child: isinstance(child, GenericNode) and child.directive is cls) :
+      placeholder.replace_self(cls.expand(document, placeholder, stack + [node.filename]))
+
+    children = content.children
+    content.children = []
+    return children
+
+  @classmethod
+  def parse(cls, document, filename):
+    """Returns a container holding the parse of filename, from the cache if its
+    content has not changed."""
+    import hashlib
+    from docutils import utils
+    from docutils.parsers import rst
+    source = read_source(filename)
+    content_hash = hashlib.sha1(source.encode("utf-8")).hexdigest()
+    if filename in _included_parses and _included_parses[filename][0] == content_hash :
+      return _included_parses[filename][1]
+
+    d("Parsing included %s" % filename)
+    included_document = utils.new_document(filename, document.settings)
+    included_document.include_parse = True
+    rst.Parser().parse(source, included_document)
+
+    # Detach the parse from its document, which the cache should not keep.  Its
+    # system messages have been reported already (and would not deepcopy).
+    for message in included_document.traverse(nodes.system_message) :
+      message.parent.remove(message)
+    container = nodes.Element()
+    container.extend(included_document.children)
+    for child in container.traverse() :
+      child.document = None
+    _included_parses[filename] = (content_hash, container)
+    return container
+
+  @staticmethod
+  def note_nodes(document, node):
+    """Registers included targets, references, etc. with the including
+    document, as the parser would have, so that transforms resolve them."""
+    for child in node.traverse() :
+      child.document = document
+      if isinstance(child, nodes.section) :
+        document.note_implicit_target(child)
+      elif isinstance(child, nodes.target) :
+        if child.get("anonymous") :
+          document.note_anonymous_target(child)
+        elif child.get("refname") :
+          document.note_indirect_target(child)
+        elif child["names"] :
+          document.note_explicit_target(child)
+      elif isinstance(child, nodes.substitution_definition) and child["names"] :
+        document.note_substitution_def(child, child["names"][0])
+      elif isinstance(child, nodes.substitution_reference) :
+        document.note_substitution_ref(child, child["refname"])
+      elif isinstance(child, nodes.reference) :
+        if child.get("anonymous") :
+          document.note_anonymous_ref(child)
+        elif child.get("refname") :
+          document.note_refname(child)
+      elif isinstance(child, nodes.pending) :
+        document.note_pending(child)
+
+  @classmethod
+  def visit(cls, writer, node):
+    writer._warning("[%s]" % node.error)
+    raise nodes.SkipNode
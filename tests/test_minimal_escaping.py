@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Nick Blundell.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# The GNU GPL is contained in /usr/doc/copyright/GPL on a Debian
+# system and in the file COPYING in the Linux kernel source.
+#
+# test_minimal_escaping (test_minimal_escaping.py)
+# ------------------------------------------------
+#
+# Description: Checks that minimal escaping typesets the same text as the
+# default escaping, by running both outputs through a model of latex's
+# ligatures.  Run with: python -m unittest discover tests
+#
+
+import os
+import unittest
+
+import rst_tex
+
+TEMPLATE = os.path.join(os.path.dirname(__file__), "paper_template.tex")
+
+# Runs of the chars minimal escaping leaves unbraced, next to each other, to
+# mapped phrases and markup, and at the ends of text.
+SOURCE = u"""
+Ligatures
+=========
+
+Dashes
+------
+
+Dashes a-b a--b a---b a----b a-----b -lead trail- -- --- ----.
+
+Quotes `x' ``q'' ```q''' it's ''' '''' rock'n'roll' 'a' `b` ` ```.
+
+Commas a,b a,,b a,,,b ,lead trail, ,, !` ?` !`` ?``` !, ?' -` '- ,' `,.
+
+Unicode a–-b a—-b ’' ’’ “x” …,
+
+Markup *a*-*b* *a-*-*-b* **x'**'' ``lit--eral`` x-*y* *y*-x a,*b*,c e.g. x, i.e. -> <- <--.
+
+* item-
+* -item
+* ,,item''
+
+Paragraph ending --
+"""
+
+# Pairs (and triples) of chars latex fonts set as one glyph.
+LIGATURES = [("---", "EMDASH"), ("--", "ENDASH"), ("``", "LDQUO"), ("''", "RDQUO"), (",,", "LOWDQUO"), ("!`", "IEXCL"), ("?`", "IQUEST")]
+
+def glyphs(latex) :
+  """Returns the glyphs latex would set for some output: a braced char ({-}) is
+  a glyph of its own, braces end runs of chars, and runs are set with the
+  font's ligatures."""
+  output = []
+  def set_run(run) :
+    index = 0
+    while index < len(run) :
+      for ligature, glyph in LIGATURES :
+        if run.startswith(ligature, index) :
+          output.append(glyph)
+          index += len(ligature)
+          break
+      else :
+        output.append(run[index])
+        index += 1
+
+  run, index = "", 0
+  while index < len(latex) :
+    if latex[index] == "{" and latex[index+2:index+3] == "}" and latex[index+1] in rst_tex.LIGATURE_CHARS :
+      set_run(run)
+      run = ""
+      output.append(latex[index+1])
+      index += 3
+    elif latex[index] in "{}" :
+      set_run(run)
+      run = ""
+      index += 1
+    else :
+      run += latex[index]
+      index += 1
+  set_run(run)
+  return output
+
+def render(source, **writer_options) :
+  writer = rst_tex.Writer(template=TEMPLATE, **writer_options)
+  return rst_tex.RenderSession(writer).render(source)
+
+
+class NoHyphenTranslator(rst_tex.LatexTranslator) :
+
+  def initialise_text_mappings(self) :
+    text_mappings = rst_tex.LatexTranslator.initialise_text_mappings(self)
+    del text_mappings["-"]
+    return text_mappings
+
+
+class MinimalEscapingTest(unittest.TestCase) :
+
+  def test_same_glyphs(self) :
+    default = render(SOURCE)
+    minimal = render(SOURCE, minimal_escaping=True)
+    self.assertTrue(len(minimal) < len(default))
+    self.assertEqual(glyphs(default), glyphs(minimal))
+
+  def test_ligatures_braced(self) :
+    minimal = render(u"Text a,,b it's x'' a----b.\n", minimal_escaping=True)
+    self.assertTrue("a{,},b it's x{'}' a---{-}b." in minimal)
+
+  def test_translator_without_mapping(self) :
+    writer = rst_tex.Writer(template=TEMPLATE, minimal_escaping=True)
+    writer.translator_class = NoHyphenTranslator
+    output = rst_tex.RenderSession(writer).render(u"Text a--b a-b.\n")
+    self.assertTrue("a--b a-b" in output)
+
+  def test_default_not_braced(self) :
+    writer = rst_tex.Writer(template=TEMPLATE)
+    writer.translator_class = NoHyphenTranslator
+    output = rst_tex.RenderSession(writer).render(u"Text a----b.\n")
+    self.assertTrue("a----b." in output)
+
+
+if __name__ == "__main__" :
+  unittest.main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010 Nick Blundell.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# The GNU GPL is contained in /usr/doc/copyright/GPL on a Debian
+# system and in the file COPYING in the Linux kernel source.
+#
+# test_rst_include (test_rst_include.py)
+# --------------------------------------
+#
+# Description: Checks that roles in included files are rendered as they are
+# in the including file, including from a cached parse.  Run with:
+# python -m unittest discover tests
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import rst_tex
+
+TEMPLATE = os.path.join(os.path.dirname(__file__), "paper_template.tex")
+
+MAIN = u"""
+Book
+====
+
+See :ref:`sec-part`.
+
+.. rst_include:: part.rst
+"""
+
+PART = u"""
+Part
+----
+
+:label:`sec-part` As :cite:`knuth84` shows, :math:`x^2` grows\\ :footnote:`Quickly.`.
+"""
+
+
+class IncludedRolesTest(unittest.TestCase) :
+
+  def setUp(self) :
+    self.directory = tempfile.mkdtemp()
+    for name, source in [("main.rst", MAIN), ("part.rst", PART)] :
+      open(os.path.join(self.directory, name), "w").write(source.encode("utf-8"))
+
+  def tearDown(self) :
+    shutil.rmtree(self.directory)
+
+  def test_roles(self) :
+    writer = rst_tex.Writer(template=TEMPLATE)
+    session = rst_tex.RenderSession(writer)
+    main = os.path.join(self.directory, "main.rst")
+    # The second render includes the cached parse of part.rst.
+    for render in range(2) :
+      output = session.render_file(main)
+      self.assertTrue("\\label{sec-part}" in output)
+      self.assertTrue("\\cite{knuth84}" in output)
+      self.assertTrue("$x^2$" in output)
+      self.assertTrue("\\footnote{Quickly.}" in output)
+      self.assertEqual(["knuth84"], sorted(writer.cite_keys))
+      self.assertEqual([], writer.label_index.dangling_refs())
+
+
+if __name__ == "__main__" :
+  unittest.main()